@@ -2,33 +2,84 @@
 
 import argparse
 import json
+import struct
 import sys
 
 from common import *
 
+# magic, signature key generation, flags, main thread priority, default CPU
+# ID, system resource size, version, main thread stack size, name, then the
+# product code, reserved space and ACI/ACID offsets + sizes (filled in later)
+META_HEADER = struct.Struct("<4sI4xBxBB4xIII16s16x48x16x")
+
+
+class NpdmConfig:
+    def __init__(self, contents: dict):
+        # META
+        self.signature_key_generation = json_read_u32(contents, "signature_key_generation", 0)
+        self.is_64_bit = json_read_bool(contents, "is_64_bit")
+        self.address_space_type = json_read_int(contents, "address_space_type", 0, 3)
+        self.optimize_memory_allocation = json_read_bool(contents, "optimize_memory_allocation", False)
+        self.disable_device_address_space_merge = json_read_bool(contents, "disable_device_address_space_merge", False)
+        self.enable_alias_region_extra_size = json_read_bool(contents, "enable_alias_region_extra_size", False)
+        self.prevent_code_reads = json_read_bool(contents, "prevent_code_reads", False)
+        self.main_thread_priority = json_read_int(contents, "main_thread_priority", 0, 0x3f)
+        self.default_cpu_id = json_read_u8(contents, "default_cpu_id")
+        self.system_resource_size = json_read_int(contents, "system_resource_size", 0, 0x1fe00000, 0)
+        self.version = json_read_u32(contents, "version", 0)
+        self.main_thread_stack_size = json_read_u32(contents, "main_thread_stack_size")
+        abort_unless(self.main_thread_stack_size & 0xfff == 0, "`main_thread_stack_size` must be aligned to 0x1000")
+        self.name = json_read_str(contents, "name", max_len=0x10)
+
+        # ACID
+        self.is_retail = json_read_bool(contents, "is_retail")
+        self.unqualified_approval = json_read_bool(contents, "unqualified_approval", False)
+        self.pool_partition = json_read_int(contents, "pool_partition", 0, 3)
+        self.program_id_range_min = json_read_u64(contents, ("program_id_range_min", "title_id_range_min"))
+        self.program_id_range_max = json_read_u64(contents, ("program_id_range_max", "title_id_range_max"))
+
+        # ACI
+        self.program_id = json_read_u64(contents, ("program_id", "title_id"))
+
+        fs_access = json_read_dict(contents, "filesystem_access")
+        self.fs_permissions = json_read_u64(fs_access, "permissions")
+
+        self.content_owner_ids = []
+        for coi in json_read_list(fs_access, "content_owner_ids", []):
+            if isinstance(coi, int):
+                val = coi
+            elif isinstance(coi, str):
+                val = int(coi, 16)
+            else:
+                abort(f"`content_owner_ids` entries must be integers")
+            abort_unless(0 <= val <= (1 << 64) - 1, f"`content_owner_ids` entries must be between 0 and {(1 << 64) - 1:#x}")
+            self.content_owner_ids.append(val)
+
+        self.sdoi_accessibilities = []
+        self.sdoi_ids = []
+        for sdoi in json_read_list(fs_access, "save_data_owner_ids", []):
+            abort_unless(isinstance(sdoi, dict), "`save_data_owner_ids` entries must be dicts")
+            self.sdoi_accessibilities.append(json_read_int(sdoi, "accessibility", 1, 3))
+            self.sdoi_ids.append(json_read_u64(sdoi, "id"))
+
 
 def write_sac(contents: dict) -> BinaryWriter:
-    writer = BinaryWriter()
     service_host = json_read_list(contents, "service_host")
     service_access = json_read_list(contents, "service_access")
-    for service in service_host:
+    for service in service_host + service_access:
         abort_unless(isinstance(service, str), "services must be strings")
         abort_unless(1 <= len(service) <= 8, "services must be between 1 and 8 chars long")
 
-        writer.write_u8(0x80 | (len(service) - 1))
-        writer.write_string(service)
-    
-    for service in service_access:
-        abort_unless(isinstance(service, str), "services must be strings")
-        abort_unless(1 <= len(service) <= 8, "services must be between 1 and 8 chars long")
-        
-        writer.write_u8(len(service) - 1)
-        writer.write_string(service)
-    
+    # each entry is a control byte (host flag | length - 1) followed by the name
+    parts = [bytes((0x80 | (len(service) - 1),)) + service.encode("ascii") for service in service_host]
+    parts += [bytes((len(service) - 1,)) + service.encode("ascii") for service in service_access]
+
+    writer = BinaryWriter()
+    writer.write_bytes(b"".join(parts))
     return writer
 
 
-def write_acid(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter) -> BinaryWriter:
+def write_acid(config: NpdmConfig, sac_writer: BinaryWriter, kc_writer: BinaryWriter) -> BinaryWriter:
     writer = BinaryWriter()
 
     writer.write_bytes(b"\x00"*0x100) # RSA2048 signature
@@ -39,25 +90,22 @@ def write_acid(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter
     writer.seek_rel(4) # TODO: skipped version and unknown 0x209 thingy
     
     acid_flags = 0
-    acid_flags |= 0b00000001 if json_read_bool(contents, "is_retail") else 0
-    acid_flags |= 0b00000010 if json_read_bool(contents, "unqualified_approval", False) else 0
-    acid_flags |= json_read_int(contents, "pool_partition", 0, 3) << 2
+    acid_flags |= 0b00000001 if config.is_retail else 0
+    acid_flags |= 0b00000010 if config.unqualified_approval else 0
+    acid_flags |= config.pool_partition << 2
     writer.write_u32(acid_flags)
-    writer.write_u64(json_read_u64(contents, ("program_id_range_min", "title_id_range_min")))
-    writer.write_u64(json_read_u64(contents, ("program_id_range_max", "title_id_range_max")))
+    writer.write_u64(config.program_id_range_min)
+    writer.write_u64(config.program_id_range_max)
     writer.seek_rel(0x20)
     
     # ACID - Filesystem Access Control
 
-    fs_access = json_read_dict(contents, "filesystem_access")
-    fs_permissions = json_read_u64(fs_access, "permissions")
-
     fac_offset = writer.position
     writer.write_u8(1) # version
     writer.write_u8(0) # content owner ID count
     writer.write_u8(0) # save data owner ID count
     writer.seek(fac_offset + 4)
-    writer.write_u64(fs_permissions)
+    writer.write_u64(config.fs_permissions)
     writer.write_u64(0) # content owner ID min
     writer.write_u64(0) # content owner ID max
     writer.write_u64(0) # save data owner ID min
@@ -68,7 +116,7 @@ def write_acid(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter
 
     writer.align(0x10)
     sac_offset = writer.position
-    sac_size = len(sac_writer.stream)
+    sac_size = sac_writer.size
     writer.seek(sac_offset)
     writer.write_sub(sac_writer)
 
@@ -76,7 +124,7 @@ def write_acid(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter
 
     writer.align(0x10)
     kc_offset = writer.position
-    kc_size = len(kc_writer.stream)
+    kc_size = kc_writer.size
     writer.seek(kc_offset)
     writer.write_sub(kc_writer)
 
@@ -95,17 +143,12 @@ def write_acid(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter
     return writer
 
 
-def write_aci(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter) -> BinaryWriter:
+def write_aci(config: NpdmConfig, sac_writer: BinaryWriter, kc_writer: BinaryWriter) -> BinaryWriter:
     writer = BinaryWriter()
 
-    fs_access = json_read_dict(contents, "filesystem_access")
-    content_owner_ids = json_read_list(fs_access, "content_owner_ids", [])
-    save_data_owner_ids = json_read_list(fs_access, "save_data_owner_ids", [])
-    fs_permissions = json_read_u64(fs_access, "permissions")
-
     writer.write_string("ACI0")
     writer.seek_rel(0xc) # reserved
-    writer.write_u64(json_read_u64(contents, ("program_id", "title_id")))
+    writer.write_u64(config.program_id)
     writer.seek_rel(0x8) # reserved
     writer.seek_rel(0x20) # skip over offsets and sizes for now
 
@@ -113,38 +156,23 @@ def write_aci(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter)
 
     fah_offset = writer.position
     writer.write_u32(1) # version
-    writer.write_u64(fs_permissions)
+    writer.write_u64(config.fs_permissions)
     writer.seek_rel(0x10) # skip over coi/sdoi offsets + sizes for now
     
     coi_offset = writer.position
-    if len(content_owner_ids):
-        writer.write_u32(len(content_owner_ids))
-    for coi in content_owner_ids:
-        if isinstance(coi, int):
-            val = coi
-        elif isinstance(coi, str):
-            val = int(coi, 16)
-        else:
-            abort(isinstance(coi, (int, str)), f"`content_owner_ids` entries must be integers")
-        abort_unless(0 <= val <= (1 << 64) - 1, f"`content_owner_ids` entries must be between 0 and {(1 << 64) - 1:#x}")
-
-        writer.write_u64(val)
+    if len(config.content_owner_ids):
+        writer.write_u32(len(config.content_owner_ids))
+    for coi in config.content_owner_ids:
+        writer.write_u64(coi)
     coi_size = writer.position - coi_offset
  
     sdoi_offset = writer.position
-    if len(save_data_owner_ids):
-        writer.write_u32(len(save_data_owner_ids))
-    sdoi_accessibilities = []
-    sdoi_ids = []
-    for sdoi in save_data_owner_ids:
-        abort_unless(isinstance(sdoi, dict), "`save_data_owner_ids` entries must be dicts")
-        sdoi_accessibilities.append(json_read_int(sdoi, "accessibility", 1, 3))
-        sdoi_ids.append(json_read_u64(sdoi, "id"))
-    
-    for accessibility in sdoi_accessibilities:
+    if len(config.sdoi_ids):
+        writer.write_u32(len(config.sdoi_ids))
+    for accessibility in config.sdoi_accessibilities:
         writer.write_u8(accessibility)
     writer.align(4)
-    for id_ in sdoi_ids:
+    for id_ in config.sdoi_ids:
         writer.write_u64(id_)
     sdoi_size = writer.position - sdoi_offset
 
@@ -174,44 +202,34 @@ def write_aci(contents: dict, sac_writer: BinaryWriter, kc_writer: BinaryWriter)
     writer.write_u32(fah_offset)
     writer.write_u32(fah_size)
     writer.write_u32(sac_offset)
-    writer.write_u32(len(sac_writer.stream))
+    writer.write_u32(sac_writer.size)
     writer.write_u32(kc_offset)
-    writer.write_u32(len(kc_writer.stream))
+    writer.write_u32(kc_writer.size)
 
     return writer
 
 
-def write_meta(contents: dict) -> BinaryWriter:
-    writer = BinaryWriter()
+def write_meta(config: NpdmConfig) -> BinaryWriter:
+    flags = 0
+    flags |= 0b00000001 if config.is_64_bit else 0
+    flags |= config.address_space_type << 1
+    flags |= 0b00010000 if config.optimize_memory_allocation else 0
+    flags |= 0b00100000 if config.disable_device_address_space_merge else 0
+    flags |= 0b01000000 if config.enable_alias_region_extra_size else 0
+    flags |= 0b10000000 if config.prevent_code_reads else 0
 
-    writer.write_string("META")
-    writer.write_u32(json_read_u32(contents, "signature_key_generation", 0))
-    writer.seek_rel(0x4) # reserved
-
-    cap = 0
-    cap |= 0b00000001 if json_read_bool(contents, "is_64_bit") else 0
-    cap |= json_read_int(contents, "address_space_type", 0, 3) << 1
-    cap |= 0b00010000 if json_read_bool(contents, "optimize_memory_allocation", False) else 0
-    cap |= 0b00100000 if json_read_bool(contents, "disable_device_address_space_merge", False) else 0
-    cap |= 0b01000000 if json_read_bool(contents, "enable_alias_region_extra_size", False) else 0
-    cap |= 0b10000000 if json_read_bool(contents, "prevent_code_reads", False) else 0
-    writer.write_u8(cap)
-    writer.seek(0xe)
-    writer.write_u8(json_read_int(contents, "main_thread_priority", 0, 0x3f))
-    writer.write_u8(json_read_u8(contents, "default_cpu_id"))
-    writer.seek(0x14)
-    writer.write_u32(json_read_int(contents, "system_resource_size", 0, 0x1fe00000, 0))
-    writer.write_u32(json_read_u32(contents, "version", 0))
-
-    main_thread_stack_size = json_read_u32(contents, "main_thread_stack_size")
-    abort_unless(main_thread_stack_size & 0xfff == 0, "`main_thread_stack_size` must be aligned to 0x1000")
-    writer.write_u32(main_thread_stack_size)
-
-    name = json_read_str(contents, "name", max_len=0x10)
-    writer.write_string(name, max_len=0x10)
-    writer.write_bytes(b"\0"*16) # product code
-    writer.seek_rel(0x30) # reserved
-    writer.seek_rel(0x10) # skip ACI/ACID offsets + sizes for now
+    writer = BinaryWriter()
+    writer.write_bytes(META_HEADER.pack(
+        b"META",
+        config.signature_key_generation,
+        flags,
+        config.main_thread_priority,
+        config.default_cpu_id,
+        config.system_resource_size,
+        config.version,
+        config.main_thread_stack_size,
+        config.name.encode("ascii"),
+    ))
 
     return writer
 
@@ -227,6 +245,7 @@ def main():
     with open(args.infile) as f:
         contents = json.load(f)
     
+    config = NpdmConfig(contents)
     writer = BinaryWriter()
 
     sac_writer = write_sac(contents)
@@ -234,8 +253,8 @@ def main():
 
     # META section
 
-    meta_writer = write_meta(contents)
-    meta_size = len(meta_writer.stream)
+    meta_writer = write_meta(config)
+    meta_size = meta_writer.size
     writer.write_sub(meta_writer)
 
     # ACID section
@@ -243,16 +262,16 @@ def main():
     writer.seek(meta_size)
     writer.align(0x10)
     acid_offset = writer.position
-    acid_writer = write_acid(contents, sac_writer, kc_writer)
-    acid_size = len(acid_writer.stream)
+    acid_writer = write_acid(config, sac_writer, kc_writer)
+    acid_size = acid_writer.size
     writer.write_sub(acid_writer)
 
     # ACI section
 
     writer.align(0x10)
     aci_offset = writer.position
-    aci_writer = write_aci(contents, sac_writer, kc_writer)
-    aci_size = len(aci_writer.stream)
+    aci_writer = write_aci(config, sac_writer, kc_writer)
+    aci_size = aci_writer.size
     writer.write_sub(aci_writer)
 
     # write ACI/ACID offsets + size into META
@@ -23,44 +23,45 @@ def main():
     entries_offset = 0x10
     string_pool_offset = entries_offset + 0x18 * entry_count
 
-    outf = open(outfile, "wb")
+    entry_sizes = []
+    for filename in filenames:
+        path = os.path.join(args.indir, filename)
+        abort_unless(not os.path.isdir(path), "input dir mustn't contain other directories")
+        entry_sizes.append(os.path.getsize(path))
+
+    # build file header, PFS0 entries and string pool up front
+    writer = BinaryWriter()
 
-    # write filenames to string pool
-    string_offsets = {}
-    outf.seek(string_pool_offset)
+    string_offsets = []
+    writer.seek(string_pool_offset)
     for filename in filenames:
-        abort_unless(not os.path.isdir(os.path.join(args.indir, filename)), "input dir mustn't contain other directories")
-        string_offsets[filename] = outf.tell() - string_pool_offset
-        write_string(outf, filename)
-        write_bytes(outf, b"\x00")
-    align(outf, 0x10)
-    data_offset = outf.tell()
+        string_offsets.append(writer.position - string_pool_offset)
+        writer.write_string(filename)
+        writer.write_u8(0)
+    writer.align(0x10)
+    data_offset = writer.position
     string_pool_size = data_offset - string_pool_offset
-    
-    # write file header
-    outf.seek(0)
-    write_string(outf, "PFS0")
-    write_u32(outf, entry_count)
-    write_u32(outf, string_pool_size)
 
-    # write PFS0 entries
-    entry_data_offset = data_offset
-    for i, filename in enumerate(filenames):
-        string_offset = string_offsets[filename]
-        entry_offset = entries_offset + 0x18 * i
+    writer.seek(0)
+    writer.write_string("PFS0")
+    writer.write_u32(entry_count)
+    writer.write_u32(string_pool_size)
 
-        outf.seek(entry_data_offset)
-        with open(os.path.join(args.indir, filename), "rb") as f:
-            while (chunk := f.read(0x100000)):
-                write_bytes(outf, chunk)
-        entry_size = outf.tell() - entry_data_offset
+    writer.seek(entries_offset)
+    entry_data_offset = 0
+    for entry_size, string_offset in zip(entry_sizes, string_offsets):
+        writer.write_u64(entry_data_offset)
+        writer.write_u64(entry_size)
+        writer.write_u32(string_offset)
+        writer.seek_rel(4) # reserved
+        entry_data_offset += entry_size
 
-        outf.seek(entry_offset)
-        write_u64(outf, entry_data_offset - data_offset)
-        write_u64(outf, entry_size)
-        write_u32(outf, string_offset)
+    # write header, then file data in one sequential pass
+    with open(outfile, "wb") as outf:
+        outf.write(writer.stream)
+        for filename, entry_size in zip(filenames, entry_sizes):
+            with open(os.path.join(args.indir, filename), "rb") as f:
+                abort_unless(copy_file(outf, f) == entry_size, f"`{filename}` changed size while building")
 
-        entry_data_offset += entry_size
-            
 if __name__ == "__main__":
     main()
@@ -1,5 +1,7 @@
 import enum
 import io
+import os
+import shutil
 import struct
 import sys
 import typing
@@ -28,30 +30,68 @@ class ByteOrder(enum.Enum):
     little = "<"
     big = ">"
 
+# precompiled structs for the fixed-width readers and writers, keyed by byte order then format
+_STRUCTS = {
+    byte_order: {fmt: struct.Struct(byte_order.value + fmt) for fmt in "?bBhHiIqQefd"}
+    for byte_order in ByteOrder
+}
+
+_U8_LE = _STRUCTS[ByteOrder.little]["B"]
+_U16_LE = _STRUCTS[ByteOrder.little]["H"]
+_U32_LE = _STRUCTS[ByteOrder.little]["I"]
+_U64_LE = _STRUCTS[ByteOrder.little]["Q"]
+
 class BinaryWriter:
+    __slots__ = ("_buffer", "_byte_order", "_packers", "_end")
+
     def __init__(self, size: int = 0, byte_order: ByteOrder = ByteOrder.little):
-        self.stream = bytearray(size)
+        self._buffer = io.BytesIO(bytes(size))
         self.byte_order = byte_order
-        self._position = 0
+        # furthest offset seeked to, the stream is zero-padded up to here
+        self._end = 0
+
+    @property
+    def byte_order(self) -> ByteOrder:
+        return self._byte_order
+
+    @byte_order.setter
+    def byte_order(self, value: ByteOrder):
+        self._byte_order = value
+        self._packers = _STRUCTS[value]
 
     @property
     def position(self) -> int:
-        return self._position
+        return self._buffer.tell()
+
+    @property
+    def size(self) -> int:
+        with self._buffer.getbuffer() as view:
+            return max(view.nbytes, self._end)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def stream(self) -> bytes:
+        data = self._buffer.getvalue()
+        if len(data) < self._end:
+            data = data.ljust(self._end, b"\0")
+        return data
 
     def save(self, filename: str):
-        with open(filename, "wb") as f:
-            f.write(self.stream)
+        # write the buffer in place rather than through a `stream` copy
+        with open(filename, "wb") as f, self._buffer.getbuffer() as view:
+            f.write(view)
+            f.write(bytes(max(self._end - view.nbytes, 0)))
     
-    def write_sub(self, other: typing.Self):
-        self.write_bytes(other.stream)
+    def write_sub(self, other: typing.Self) -> int:
+        return self._buffer.write(other.stream)
 
     def seek(self, offset: int, *, relative: bool = False):
-        if relative:
-            self._position += offset
-        else:
-            self._position = offset
-        
-        self._fill_bytes(0)
+        # BytesIO zero-fills gaps on the next write, only the end needs tracking
+        position = self._buffer.seek(offset, io.SEEK_CUR if relative else io.SEEK_SET)
+        if position > self._end:
+            self._end = position
     
     def seek_rel(self, offset: int):
         self.seek(offset, relative=True)
@@ -59,26 +99,11 @@ class BinaryWriter:
     def align(self, alignment: int):
         self.seek(round_up(self.position, alignment))
 
-    def _fill_bytes(self, offset: int, relative: bool = True):
-        bytes_to_add = offset - len(self.stream)
-        if relative:
-            bytes_to_add += self.position
-
-        if bytes_to_add > 0:
-            self.stream += bytearray(bytes_to_add)
-
     def write(self, raw: bytes) -> int:
-        start = self._position
-        self._fill_bytes(len(raw))
-        for byte in raw:
-            self.stream[self._position] = byte
-            self._position += 1
-        return self._position - start
+        return self._buffer.write(raw)
 
     def _write(self, fmt: str, value) -> int:
-        endianness = self.byte_order.value
-        raw = struct.pack(endianness + fmt, value)
-        return self.write(raw)
+        return self._buffer.write(self._packers[fmt].pack(value))
 
     def write_bool(self, value: bool) -> int:
         return self._write("?", value)
@@ -96,10 +121,7 @@ class BinaryWriter:
         return self._write("H", value)
 
     def write_u24(self, value: int) -> int:
-        if self.byte_order == ByteOrder.little:
-            return self.write(struct.pack("<I", value)[:3])
-        else:
-            return self.write(struct.pack(">I", value)[1:])
+        return self.write(value.to_bytes(3, self.byte_order.name))
 
     def write_s32(self, value: int) -> int:
         return self._write("i", value)
@@ -124,8 +146,7 @@ class BinaryWriter:
     
     def write_string(self, value: str, *, max_len: int = -1) -> int:
         if max_len > 0:
-            value = value[:max_len]
-            return self.write("{:\0<{max_len}}".format(value, max_len=max_len).encode("ascii"))
+            return self.write(value.encode("ascii")[:max_len].ljust(max_len, b"\0"))
         else:
             return self.write(value.encode("ascii"))
 
@@ -170,10 +191,13 @@ class BinaryReader:
             self._check_len(out, size)
         return out
     
-    def _read(self, size: int, fmt: str, type_: type) -> typing.Any:
-        out = self.read(size)
-        endianness = self.byte_order.value
-        return type_(*struct.unpack(endianness + fmt, out))
+    def _read(self, fmt: str) -> typing.Any:
+        packer = _STRUCTS[self.byte_order][fmt]
+        if self._position + packer.size > len(self.stream):
+            raise OSError("EOF reached")
+        value = packer.unpack_from(self.stream, self._position)[0]
+        self._position += packer.size
+        return value
 
     def peek(self, size: int = 1) -> bytes:
         offset = self.position
@@ -189,16 +213,16 @@ class BinaryReader:
             return True
         
     def read_s8(self) -> int:
-        return self._read(1, "b", int)
+        return self._read("b")
 
     def read_u8(self) -> int:
-        return self._read(1, "B", int)
+        return self._read("B")
         
     def read_s16(self) -> int:
-        return self._read(2, "h", int)
+        return self._read("h")
 
     def read_u16(self) -> int:
-        return self._read(2, "H", int)
+        return self._read("H")
     
     def read_u24(self) -> int:
         out = self.read(3)
@@ -208,28 +232,28 @@ class BinaryReader:
             return struct.unpack(">I", b'\x00' + out)[0]
         
     def read_s32(self) -> int:
-        return self._read(4, "i", int)
+        return self._read("i")
 
     def read_u32(self) -> int:
-        return self._read(4, "I", int)
+        return self._read("I")
         
     def read_s64(self) -> int:
-        return self._read(8, "q", int)
+        return self._read("q")
 
     def read_u64(self) -> int:
-        return self._read(8, "Q", int)
+        return self._read("Q")
         
     def read_bytes(self, size: int) -> bytes:
         return self.read(size)
     
     def read_f16(self) -> float:
-        return self._read(2, "s", float)
+        return self._read("e")
         
     def read_f32(self) -> float:
-        return self._read(4, "f", float)
+        return self._read("f")
     
     def read_f64(self) -> float:
-        return self._read(8, "d", float)
+        return self._read("d")
     
     def read_bools(self, count: int) -> list[bool]:
         return [self.read_bool() for _ in range(count)]
@@ -269,8 +293,9 @@ class BinaryReader:
 
     def read_string(self, encoding_name: str, size: int = -1, char_size: int = 1) -> str:
         if size == -1:
-            out = b""
-            while (char := self.read(char_size)) != b'\x00':
+            out = bytearray()
+            terminator = bytes(char_size)
+            while (char := self.read(char_size)) != terminator:
                 out += char
         else:
             out = self.read(size, suppress=True)
@@ -302,48 +327,71 @@ class BinaryReader:
         return self.byte_order
     
     def align(self, alignment: int):
-        pos = self.position
-        delta = (-pos % alignment + alignment) % alignment
-        self.seek(delta, relative=True)
+        self.seek(round_up(self.position, alignment))
 
 
 def write_u8(fp: io.BufferedWriter, value: int):
-    fp.write(struct.pack("<B", value))
+    fp.write(_U8_LE.pack(value))
 
 def write_u16(fp: io.BufferedWriter, value: int):
-    fp.write(struct.pack("<H", value))
+    fp.write(_U16_LE.pack(value))
 
 def write_u32(fp: io.BufferedWriter, value: int):
-    fp.write(struct.pack("<I", value))
+    fp.write(_U32_LE.pack(value))
 
 def write_u64(fp: io.BufferedWriter, value: int):
-    fp.write(struct.pack("<Q", value))
+    fp.write(_U64_LE.pack(value))
 
 def write_bytes(fp: io.BufferedWriter, value: bytes):
     fp.write(value)
 
 def write_string(fp: io.BufferedWriter, value: str, *, max_len: int = -1):
     if max_len > 0:
-        value = value[:max_len]
-        fp.write("{:\0<{max_len}}".format(value, max_len=max_len).encode("ascii"))
+        fp.write(value.encode("ascii")[:max_len].ljust(max_len, b"\0"))
     else:
         fp.write(value.encode("ascii"))
 
+def copy_file(fp: io.BufferedWriter, src: io.BufferedReader) -> int:
+    start = fp.tell()
+    if hasattr(os, "sendfile"):
+        # let the kernel copy the data, then resync the buffered writer with the fd position
+        size = os.fstat(src.fileno()).st_size
+        fp.flush()
+        copied = 0
+        try:
+            while copied < size:
+                sent = os.sendfile(fp.fileno(), src.fileno(), copied, size - copied)
+                abort_unless(sent > 0, "unexpected EOF")
+                copied += sent
+        except OSError:
+            # macOS and the BSDs only sendfile to sockets, only a failure on the first chunk means unsupported
+            if copied > 0:
+                raise
+        else:
+            fp.seek(start + size)
+            return size
+
+    shutil.copyfileobj(src, fp, 0x100000)
+    return fp.tell() - start
+
 def align(fp: io.BufferedWriter, alignment: int):
-    fp.seek(round_up(fp.tell(), alignment), io.SEEK_CUR)
+    fp.seek(round_up(fp.tell(), alignment))
 
 
 def json_read_value(json: dict, keys: str, default: typing.Any) -> (str, typing.Any):
     if isinstance(keys, str):
+        # single key, the common case
+        if keys in json:
+            return (keys, json[keys])
         keys = (keys,)
-    
-    for key in keys:
-        if key in json:
-            return (key, json[key])
+    else:
+        for key in keys:
+            if key in json:
+                return (key, json[key])
     
     if default is not None:
-        return (key[0], default)
-    abort(f"couldn't find key `{key[0]}`")
+        return (keys[0], default)
+    abort(f"couldn't find key `{keys[0]}`")
 
 def json_read_dict(json: dict, key: str, default: dict = None) -> dict:
     key, data = json_read_value(json, key, default)
@@ -373,7 +421,7 @@ def json_read_int(json: dict, key: str, min_val: int, max_val: int, default: int
     elif isinstance(data, str):
         val = int(data, 16)
     else:
-        abort(isinstance(data, (int, str)), f"`{key}` must be an integer")
+        abort(f"`{key}` must be an integer")
 
     abort_unless(min_val <= val <= max_val, f"`{key}` must be between {min_val:#x} and {max_val:#x}")
     return val
@@ -391,8 +439,20 @@ def json_read_u8(json: dict, key: str, default: int = None) -> int:
     return json_read_int(json, key, 0, (1 << 8) - 1, default)
 
 
+# kernel capability type prefixes, a capability of type N has its low N bits set
+_KC_PREFIX_KERNEL_FLAGS = (1 << 3) - 1
+_KC_PREFIX_SYSCALLS = (1 << 4) - 1
+_KC_PREFIX_MAP = (1 << 6) - 1
+_KC_PREFIX_MAP_PAGE = (1 << 7) - 1
+_KC_PREFIX_MAP_REGION = (1 << 10) - 1
+_KC_PREFIX_IRQ_PAIR = (1 << 11) - 1
+_KC_PREFIX_APPLICATION_TYPE = (1 << 13) - 1
+_KC_PREFIX_MIN_KERNEL_VERSION = (1 << 14) - 1
+_KC_PREFIX_HANDLE_TABLE_SIZE = (1 << 15) - 1
+_KC_PREFIX_DEBUG_FLAGS = (1 << 16) - 1
+
 def write_kc(contents: dict) -> BinaryWriter:
-    writer = BinaryWriter()
+    caps = []
     kernel_caps = json_read_list(contents, "kernel_capabilities")
     for cap_idx, cap in enumerate(kernel_caps):
         abort_unless(isinstance(cap, dict), "kernel capabilities must be dicts")
@@ -401,12 +461,12 @@ def write_kc(contents: dict) -> BinaryWriter:
         type_ = json_read_str(cap, "type")
         if type_ == "kernel_flags":
             value = json_read_dict(cap, "value")
-            cap = (1 << 3) - 1
+            cap = _KC_PREFIX_KERNEL_FLAGS
             cap |= json_read_int(value, "highest_thread_priority", 0, 63) << 4
             cap |= json_read_int(value, "lowest_thread_priority", 0, 63) << 10
             cap |= json_read_u8(value, "lowest_cpu_id") << 16
             cap |= json_read_u8(value, "highest_cpu_id") << 24
-            writer.write_u32(cap)
+            caps.append(cap)
         elif type_ == "syscalls":
             value = json_read_dict(cap, "value")
             groups = [0] * 8
@@ -416,47 +476,48 @@ def write_kc(contents: dict) -> BinaryWriter:
                 elif isinstance(data, str):
                     val = int(data, 16)
                 else:
-                    abort(isinstance(data, (int, str)), f"syscalls must be integers")
+                    abort("syscalls must be integers")
 
                 abort_unless(0 <= val <= 0xbf, "syscall values must be between 0 and 0xbf")
                 groups[val // 24] |= 1 << (val % 24)
             
             for idx, group in enumerate(groups):
                 if group:
-                    cap = (1 << 4) - 1
+                    cap = _KC_PREFIX_SYSCALLS
                     cap |= group << 5
                     cap |= idx << 29
-                    writer.write_u32(cap)
+                    caps.append(cap)
         elif type_ == "map":
             value = json_read_dict(cap, "value")
 
-            cap = (1 << 6) - 1
+            cap = _KC_PREFIX_MAP
             cap |= json_read_int(value, "address", 0, (1 << 24) - 1) << 7
             cap |= (1 << 31) if json_read_bool(value, "is_ro") else 0
-            writer.write_u32(cap)
+            caps.append(cap)
 
-            cap = (1 << 6) - 1
+            cap = _KC_PREFIX_MAP
             cap |= json_read_int(value, "size", 0, (1 << 20) - 1) << 7
             cap |= (1 << 31) if json_read_bool(value, "is_io") else 0
-            writer.write_u32(cap)
+            caps.append(cap)
         elif type_ == "map_page":
-            cap = (1 << 7) - 1
-            cap |= json_read_int(cap, "value", 0, (1 << 24) - 1) << 8
-            writer.write_u32(cap)
+            value = json_read_int(cap, "value", 0, (1 << 24) - 1)
+            cap = _KC_PREFIX_MAP_PAGE
+            cap |= value << 8
+            caps.append(cap)
         elif type_ == "map_region":
             value = json_read_list(cap, "value")
             abort_unless(len(value) <= 3, "`map_region` can have a maximum of 3 regions")
-            cap = (1 << 10) - 1
+            cap = _KC_PREFIX_MAP_REGION
             for i, region in enumerate(value):
                 abort_unless(isinstance(region, dict), "`map_region` entries must be dicts")
                 cap |= json_read_int(region, "region_type", 0, 3) << (11 + 7 * i)
                 cap |= (1 << (17 + 7 * i)) if json_read_bool(region, "is_ro") else 0
             
-            writer.write_u32(cap)
+            caps.append(cap)
         elif type_ == "irq_pair":
             value = json_read_list(cap, "value")
             abort_unless(len(value) == 2, "`irq_pair` must contain 2 elements")
-            cap = (1 << 11) - 1
+            cap = _KC_PREFIX_IRQ_PAIR
             for i, irq in enumerate(value):
                 if irq is None:
                     irq_value = 0x3ff
@@ -472,22 +533,22 @@ def write_kc(contents: dict) -> BinaryWriter:
 
                 cap |= irq_value << (11 + i * 10)
 
-            writer.write_u32(cap)
+            caps.append(cap)
         elif type_ == "application_type":
             value = json_read_int(cap, "value", 0, 2, 0)
-            cap = (1 << 13) - 1
+            cap = _KC_PREFIX_APPLICATION_TYPE
             cap |= value << 14
-            writer.write_u32(cap)
+            caps.append(cap)
         elif type_ == "min_kernel_version":
             value = json_read_u16(cap, "value")
-            cap = (1 << 14) - 1
+            cap = _KC_PREFIX_MIN_KERNEL_VERSION
             cap |= value << 15
-            writer.write_u32(cap)
+            caps.append(cap)
         elif type_ == "handle_table_size":
             value = json_read_int(cap, "value", 0, (1 << 10) - 1)
-            cap = (1 << 15) - 1
+            cap = _KC_PREFIX_HANDLE_TABLE_SIZE
             cap |= value << 16
-            writer.write_u32(cap)
+            caps.append(cap)
         elif type_ == "debug_flags":
             value = json_read_dict(cap, "value")
             allow_debug = json_read_bool(value, "allow_debug", False)
@@ -498,12 +559,14 @@ def write_kc(contents: dict) -> BinaryWriter:
                 "only one of `allow_debug`, `force_debug`, or `force_debug_prod` can be set"
             )
 
-            cap = (1 << 16) - 1
+            cap = _KC_PREFIX_DEBUG_FLAGS
             cap |= (1 << 17) if allow_debug else 0
             cap |= (1 << 18) if force_debug_prod else 0
             cap |= (1 << 19) if force_debug else 0
-            writer.write_u32(cap)
+            caps.append(cap)
         else:
             abort(f"unrecognised kernel capability type `{type_}`")
-    
+
+    writer = BinaryWriter()
+    writer.write_bytes(struct.pack(f"<{len(caps)}I", *caps))
     return writer
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import errno
+import mmap
 import os
-import shutil
+import re
 import struct
 import sys
 import typing
@@ -17,46 +20,117 @@ def abort_unless(cond: bool, msg: str):
         abort(msg)
 
 
-def read_bytes(data: bytes, offset: int, size: int) -> bytes:
-    abort_unless(offset + size < len(data), "unexpected EOF")
-    return data[offset:offset+size]
-
-def read_string(data: bytes, offset: int, size: int = -1, encoding_name: str = "ascii") -> str:
-    if size == -1:
-        out = b""
-        i = 0
-        while (char := read_bytes(data, offset+i, 1)) != b'\x00':
-            out += char
-            i += 1
-    else:
-        out = read_bytes(data, offset, size)
-    
-    return out.decode(encoding_name)
-
-def read_signature(data: bytes, offset: int, size: int, expected: str) -> str:
-    signature = read_string(data, offset, size)
-    abort_unless(signature == expected, f"file signature was {signature}, expected {expected}")
-    return signature
-
-def read_u8(data: bytes, offset: int) -> int:
-    out = read_bytes(data, offset, 1)
-    return int(*struct.unpack("<B", out))
-
-def read_u16(data: bytes, offset: int) -> int:
-    out = read_bytes(data, offset, 2)
-    return int(*struct.unpack("<H", out))
-
-def read_u32(data: bytes, offset: int) -> int:
-    out = read_bytes(data, offset, 4)
-    return int(*struct.unpack("<I", out))
-
-def read_u64(data: bytes, offset: int) -> int:
-    out = read_bytes(data, offset, 8)
-    return int(*struct.unpack("<Q", out))
-
-def align(offset: int, alignment: int):
-    delta = (-offset % alignment + alignment) % alignment
-    return offset + delta
+# magic, entry count, string pool size
+PFS0_HEADER = struct.Struct("<4sII4x")
+# data offset, data size, string offset
+PFS0_ENTRY = struct.Struct("<QQI4x")
+
+# empty names, absolute paths, drive letters, `.` and `..` components, trailing separators and embedded nulls
+UNSAFE_NAME = re.compile(r"^$|^[/\\]|^[A-Za-z]:|(^|[/\\])\.{1,2}([/\\]|$)|[/\\]$|\x00")
+
+# errors meaning an in-kernel copy isn't possible for these fds, rather than a real I/O failure,
+# ENOTSOCK is sendfile on macOS and the BSDs, which only writes to sockets
+UNSUPPORTED_COPY_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK}
+
+# chunk size for copies that go through userspace, keeps the working set in cache
+COPY_CHUNK_SIZE = 1 << 20
+
+# smaller files fit in a handful of extents anyway, preallocating them isn't worth the syscall
+FALLOCATE_MIN_SIZE = 1 << 20
+
+# filesystems implementing fallocate(2), on anything else (NFSv3, FUSE, CIFS, ...) glibc's
+# posix_fallocate emulates it by writing to every block, which is slower than not preallocating
+FALLOCATE_FILESYSTEMS = {"ext4", "xfs", "btrfs", "tmpfs", "f2fs", "bcachefs", "ocfs2", "gfs2"}
+
+
+def read_string(data: bytes, offset: int, encoding_name: str = "ascii", limit: int = -1) -> str:
+    # find() rather than index() so mmaps work too, the terminator must come before `limit`
+    end = data.find(b'\x00', offset, len(data) if limit == -1 else limit)
+    abort_unless(end != -1, "unexpected EOF")
+    return data[offset:end].decode(encoding_name)
+
+def read_at(fd: int, offset: int, size: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def copy_range(in_fd: int, out_fd: int, offset: int, size: int):
+    # copy in the kernel where possible, falling back to sendfile then to a plain read/write loop
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    use_sendfile = hasattr(os, "sendfile")
+    end = offset + size
+    while offset < end:
+        remaining = end - offset
+        try:
+            if use_copy_file_range:
+                copied = os.copy_file_range(in_fd, out_fd, remaining, offset)
+            elif use_sendfile:
+                copied = os.sendfile(out_fd, in_fd, offset, remaining)
+            else:
+                copied = os.write(out_fd, read_at(in_fd, offset, min(remaining, COPY_CHUNK_SIZE)))
+        except OSError as e:
+            # e.g. copy_file_range across filesystems, don't retry the same call for every chunk
+            if e.errno not in UNSUPPORTED_COPY_ERRNOS or not (use_copy_file_range or use_sendfile):
+                raise
+            if use_copy_file_range:
+                use_copy_file_range = False
+            else:
+                use_sendfile = False
+            continue
+
+        abort_unless(copied > 0, "unexpected EOF")
+        offset += copied
+
+def fadvise(fd: int, offset: int, size: int, advice: str):
+    # page cache hints only, silently skipped where unsupported
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, size, getattr(os, advice))
+        except OSError:
+            pass
+
+def supports_fallocate(path: str) -> bool:
+    if not hasattr(os, "posix_fallocate"):
+        return False
+    if not sys.platform.startswith("linux"):
+        # only glibc falls back to writing every block, elsewhere unsupported filesystems just fail
+        return True
+
+    # find the filesystem of the deepest mount containing path, later mounts shadow earlier ones
+    path = os.path.realpath(path)
+    fs_type = None
+    longest_mount_len = -1
+    try:
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+                if path != mount_point and not path.startswith(mount_point.rstrip("/") + "/"):
+                    continue
+                if len(mount_point) >= longest_mount_len:
+                    longest_mount_len = len(mount_point)
+                    fs_type = fields[fields.index("-", 6) + 1]
+    except (OSError, ValueError, IndexError):
+        return False
+
+    return fs_type in FALLOCATE_FILESYSTEMS
+
+def extract_entry(in_fd: int, out_path: str, offset: int, size: int, preallocate: bool):
+    # raw fd, the copy never goes through a Python-level buffer
+    out_fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        if preallocate and size >= FALLOCATE_MIN_SIZE:
+            # reserve the extents up front, this is only a hint so failures are ignored
+            try:
+                os.posix_fallocate(out_fd, 0, size)
+            except OSError:
+                pass
+        copy_range(in_fd, out_fd, offset, size)
+        # each entry is read exactly once, don't let it linger in the page cache
+        fadvise(in_fd, offset, size, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(out_fd)
 
 def pretty_size(size: int) -> str:
     if size < 1024:
@@ -79,38 +153,49 @@ def main():
     args = parser.parse_args()
 
     abort_unless(os.path.isfile(args.infile), "input file doesn't exist")
+    abort_unless(os.path.getsize(args.infile) >= 0x10, "unexpected EOF")
     outdir = os.path.splitext(args.infile)[0] if args.outdir is None else args.outdir
 
     os.makedirs(outdir, exist_ok=True)
+    preallocate = supports_fallocate(outdir)
 
-    with open(args.infile, "rb") as f:
-        header = f.read(0x10)
-    
-        read_signature(header, 0x0, 4, "PFS0")
-        entry_count = read_u32(header, 0x4)
-        string_pool_size = read_u32(header, 0x8)
-        string_pool_offset = 0x10 + 0x18 * entry_count
+    with open(args.infile, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+        fadvise(f.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+        magic, entry_count, string_pool_size = PFS0_HEADER.unpack_from(contents, 0x0)
+        abort_unless(magic == b"PFS0", f"file signature was {magic.decode('ascii', 'replace')}, expected PFS0")
+        string_pool_offset = PFS0_HEADER.size + PFS0_ENTRY.size * entry_count
         data_offset = string_pool_offset + string_pool_size
+        abort_unless(data_offset <= len(contents), "unexpected EOF")
 
         if entry_count == 0:
             print("finished (PFS0 entry count: 0)")
             return 0
 
-        f.seek(string_pool_offset)
-        string_pool = f.read(string_pool_size)
+        # split the string pool once, names are looked up by their offset into it
+        string_pool = {}
+        string_offset = 0
+        # (the last piece has no terminator inside the pool, so it isn't a complete name)
+        for string in contents[string_pool_offset:data_offset].split(b"\x00")[:-1]:
+            string_pool[string_offset] = string
+            string_offset += len(string) + 1
 
         entries = []
-        f.seek(0x10)
-        for i in range(entry_count):
-            entry_header = f.read(0x18)
-            offset = read_u64(entry_header, 0x0)
-            size = read_u64(entry_header, 0x8)
-            name_offset = read_u32(entry_header, 0x10)
-
-            name = read_string(string_pool, name_offset)
-            entry_data_offset = data_offset + offset
-
-            entries.append((entry_data_offset, size, name))
+        with memoryview(contents) as view:
+            for offset, size, name_offset in PFS0_ENTRY.iter_unpack(view[PFS0_HEADER.size:string_pool_offset]):
+                abort_unless(name_offset < string_pool_size, "unexpected EOF")
+                if name_offset in string_pool:
+                    name = string_pool[name_offset].decode("ascii")
+                else:
+                    # offset points into the middle of a string, which must still end inside the pool
+                    name = read_string(contents, string_pool_offset + name_offset, limit=data_offset)
+                entry_data_offset = data_offset + offset
+
+                entries.append((entry_data_offset, size, name))
+
+        # reject names that would escape outdir before anything is written
+        unsafe_names = [name for _, _, name in entries if UNSAFE_NAME.search(name)]
+        if unsafe_names:
+            abort(f"unsafe file name `{unsafe_names[0]}`")
         
         if not args.quiet:
             longest_name_len = max(map(lambda k: len(k[2]), entries))
@@ -123,16 +208,34 @@ def main():
             
             print()
 
+        # entries sharing an output path would be copied concurrently and interleave,
+        # so only the last one is kept, as if they had been extracted one after another
+        jobs = {}
+        made_dirs = {outdir}
         for offset, size, name in entries:
             out_path = os.path.join(outdir, name)
-
+            abort_unless(offset + size <= len(contents), "unexpected EOF")
+            jobs.pop(os.path.normpath(out_path), None)
+            jobs[os.path.normpath(out_path)] = (name, out_path, offset, size)
+
+            # create parent dirs of nested names once, up front
+            parent = os.path.dirname(out_path)
+            if parent not in made_dirs:
+                os.makedirs(parent, exist_ok=True)
+                made_dirs.add(parent)
+
+        def run_job(job: tuple[str, str, int, int]):
+            name, out_path, offset, size = job
             if not args.quiet:
-                print("copying {} to {}...".format(name, out_path))
-
-            f.seek(offset)
-            with open(out_path, "wb") as outf:
-                shutil.copyfileobj(f, outf, size)
-
+                # single write so lines from different workers don't interleave
+                print("copying {} to {}...\n".format(name, out_path), end="", flush=True)
+            extract_entry(f.fileno(), out_path, offset, size, preallocate)
+
+        # the copies are I/O bound and release the GIL, but the read_at() fallback
+        # seeks the shared fd when pread is unavailable so it has to stay serial
+        max_workers = min(32, (os.cpu_count() or 1) * 4) if hasattr(os, "pread") else 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            list(executor.map(run_job, jobs.values()))
 
 if __name__ == "__main__":
     main()